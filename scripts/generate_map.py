@@ -5,10 +5,13 @@ import os
 import io
 import json
 import base64
+import functools
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
 from PIL import Image, ImageDraw
 from pillow_heif import register_heif_opener
-import exifread
-from github import Github, Auth
+from github import Github, Auth, InputGitTreeElement
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 
@@ -25,78 +28,186 @@ register_heif_opener()
 FOLDER_ID = '1d9C_qIKxBlzngjpZjgW68kIZkPZ0NAwH'
 REPO_NAME = 'K03-02/photomap'
 HTML_NAME = 'index.html'
+PHOTOS_JSON_NAME = 'photos.json'
 CACHE_FILE = 'photomap_cache.json'
 BRANCH_NAME = 'main'
 IMAGES_DIR = 'images'
+POPUP_MAX_SIZE = 1600  # ポップアップ画像の長辺（表示幅 800px の 2 倍）
+POPUP_PASSTHROUGH_MAX_BYTES = 2 * 1024 * 1024  # これ以下の JPEG は再エンコードせずそのまま使う
+MAX_WORKERS = 8  # Drive ダウンロードの並列数（スレッド）
+DRIVE_NUM_RETRIES = 5  # 429 / 5xx は googleapiclient が指数バックオフで再試行
+EXIF_PROBE_BYTES = 256 * 1024  # JPEG の APP1 / HEIC の meta・Exif はふつうこの範囲に入る
+EXIF_PROBE_MIME_TYPES = ('image/jpeg', 'image/heic', 'image/heif')
+RENDER_WORKERS = os.cpu_count() or 1  # デコード〜画像生成の並列数（プロセス）
+RENDER_QUEUE_SIZE = 2 * RENDER_WORKERS  # ダウンロード中＋描画待ちの上限（元画像をメモリに持つ枚数）
+
+# ===== HTML（静的、マーカーは photos.json を読み込んで JS 側でまとめて生成する） =====
+MAP_HTML = "\n".join([
+    "<!DOCTYPE html>",
+    "<html><head><meta charset='utf-8'><title>Photo Map</title>",
+    "<style>#map { height: 100vh; width: 100%; }</style>",
+    "<link rel='stylesheet' href='https://unpkg.com/leaflet@1.9.4/dist/leaflet.css'/>",
+    "<link rel='stylesheet' href='https://unpkg.com/leaflet.markercluster@1.5.3/dist/MarkerCluster.css'/>",
+    "<link rel='stylesheet' href='https://unpkg.com/leaflet.markercluster@1.5.3/dist/MarkerCluster.Default.css'/>",
+    "<script src='https://unpkg.com/leaflet@1.9.4/dist/leaflet.js'></script>",
+    "<script src='https://unpkg.com/leaflet.markercluster@1.5.3/dist/leaflet.markercluster.js'></script></head><body>",
+    "<div id='map'></div><script>",
+    "var map = L.map('map').setView([35.0, 138.0], 5);",
+    "L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png', {maxZoom:19}).addTo(map);",
+    "var cluster = L.markerClusterGroup({chunkedLoading: true, chunkInterval: 50});",
+    f"""
+fetch('{PHOTOS_JSON_NAME}').then(function(r) {{ return r.json(); }}).then(function(photos) {{
+    var markers = [];
+    photos.forEach(function(p) {{
+        var icon = L.icon({{
+            iconUrl: p.icon,
+            iconSize: [80, 80], // HTMLで調整可能
+            className: 'custom-icon'
+        }});
+        var marker = L.marker([p.lat, p.lon], {{icon: icon}});
+        marker.bindPopup(
+            "<b>" + p.filename + "</b><br>" + p.datetime + "<br>"
+            + "<a href='https://www.google.com/maps/search/?api=1&query=" + p.lat + "," + p.lon + "' target='_blank'>Google Mapsで開く</a><br>"
+            + "<img src='" + p.popup + "' style='width:800px; height:auto;'/>",
+            {{
+                maxWidth: 820,        // ポップアップ幅
+                autoPan: true,        // ポップアップ開いたら自動スクロール
+                autoPanPadding: [50,50] // 端から余白50px
+            }}
+        );
+        markers.push(marker);
+    }});
+    cluster.addLayers(markers); // chunkedLoading は addLayers でまとめて渡すと効く
+    cluster.addTo(map);
+}});""",
+    "</script></body></html>"])
 
 # ===== Google Drive 認証 =====
-token_info = json.loads(base64.b64decode(os.environ['USER_OAUTH_B64']))
-creds = Credentials(
-    token=token_info['token'],
-    refresh_token=token_info['refresh_token'],
-    token_uri=token_info['token_uri'],
-    client_id=token_info['client_id'],
-    client_secret=token_info.get('client_secret'),
-    scopes=token_info.get('scopes')
-)
-drive_service = build('drive', 'v3', credentials=creds)
+# 画像生成は spawn したプロセスでこのファイルを import し直すので、認証は main() から呼ぶ
+def load_drive_credentials():
+    token_info = json.loads(base64.b64decode(os.environ['USER_OAUTH_B64']))
+    return Credentials(
+        token=token_info['token'],
+        refresh_token=token_info['refresh_token'],
+        token_uri=token_info['token_uri'],
+        client_id=token_info['client_id'],
+        client_secret=token_info.get('client_secret'),
+        scopes=token_info.get('scopes')
+    )
+
+# httplib2 はスレッドセーフではないので Drive クライアントはスレッドごとに作る
+_thread_local = threading.local()
+
+def get_drive_service(creds):
+    service = getattr(_thread_local, 'drive_service', None)
+    if service is None:
+        # ディスカバリー文書は同梱のものが使われるので file_cache の自動検出は省く
+        service = build('drive', 'v3', credentials=creds, cache_discovery=False)
+        _thread_local.drive_service = service
+    return service
 
 # ===== GitHub 認証 =====
-g = Github(auth=Auth.Token(os.environ['GITHUB_TOKEN']))
-repo = g.get_repo(REPO_NAME)
+def get_github_repo():
+    g = Github(auth=Auth.Token(os.environ['GITHUB_TOKEN']))
+    return g.get_repo(REPO_NAME)
 
 # ===== ヘルパー関数 =====
-def list_image_files(folder_id):
+def list_image_files(creds, folder_id):
     query = f"'{folder_id}' in parents and mimeType contains 'image/' and trashed=false"
-    results = drive_service.files().list(q=query, fields="files(id, name)").execute()
-    return results.get('files', [])
+    files = []
+    page_token = None
+    while True:
+        results = get_drive_service(creds).files().list(
+            q=query,
+            fields="nextPageToken, files(id, name, mimeType, size, md5Checksum, modifiedTime)",
+            pageSize=1000,
+            pageToken=page_token
+        ).execute(num_retries=DRIVE_NUM_RETRIES)
+        files.extend(results.get('files', []))
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return files
+
+# piexif の GPS 値は ((分子, 分母), (分子, 分母), (分子, 分母))、ref は b'N' など
+def dms_to_dd(dms, ref):
+    (deg_n, deg_d), (min_n, min_d), (sec_n, sec_d) = dms
+    # 整数のまま通分して割り算は 1 回だけ（誤差も 1 回の丸めのみ）
+    dd = (deg_n*min_d*sec_d*3600 + min_n*deg_d*sec_d*60 + sec_n*deg_d*min_d) / (3600*deg_d*min_d*sec_d)
+    if ref not in (b'N', b'E'):
+        dd = -dd
+    return dd
 
-def extract_exif(file_bytes):
+# exif_bytes は Image.open(...).info['exif']（JPEG / HEIC とも画素のデコード不要）
+def extract_exif(exif_bytes):
     lat = lon = dt = ''
+    if not exif_bytes:
+        return lat, lon, dt
     try:
-        tags = exifread.process_file(io.BytesIO(file_bytes), details=False)
-        if 'EXIF DateTimeOriginal' in tags:
-            dt = str(tags['EXIF DateTimeOriginal'])
-        if 'GPS GPSLatitude' in tags and 'GPS GPSLongitude' in tags:
-            def dms_to_dd(dms, ref):
-                deg = float(dms.values[0].num)/dms.values[0].den
-                min_ = float(dms.values[1].num)/dms.values[1].den
-                sec = float(dms.values[2].num)/dms.values[2].den
-                dd = deg + min_/60 + sec/3600
-                if ref.values not in ['N','E']:
-                    dd = -dd
-                return dd
-            lat = dms_to_dd(tags['GPS GPSLatitude'], tags['GPS GPSLatitudeRef'])
-            lon = dms_to_dd(tags['GPS GPSLongitude'], tags['GPS GPSLongitudeRef'])
+        exif = piexif.load(exif_bytes)
+        dt_raw = exif['Exif'].get(piexif.ExifIFD.DateTimeOriginal)
+        if dt_raw:
+            dt = dt_raw.decode('ascii', errors='replace')
+        gps = exif['GPS']
+        if piexif.GPSIFD.GPSLatitude in gps and piexif.GPSIFD.GPSLongitude in gps:
+            lat = dms_to_dd(gps[piexif.GPSIFD.GPSLatitude], gps[piexif.GPSIFD.GPSLatitudeRef])
+            lon = dms_to_dd(gps[piexif.GPSIFD.GPSLongitude], gps[piexif.GPSIFD.GPSLongitudeRef])
     except Exception as e:
         print(f"⚠️ EXIF not found: {e}")
     return lat, lon, dt
 
-def upload_file_to_github(local_bytes, path, commit_msg):
-    try:
-        contents = repo.get_contents(path, ref=BRANCH_NAME)
-        repo.update_file(path, commit_msg, local_bytes, contents.sha, branch=BRANCH_NAME)
-    except:
-        repo.create_file(path, commit_msg, local_bytes, branch=BRANCH_NAME)
+def pages_url(path):
     return f"https://{os.environ.get('GITHUB_USER','K03-02')}.github.io/photomap/{path}"
 
-# ===== ポップアップ画像（元サイズ） =====
+# ===== GitHub へはブロブを作ってから 1 コミットでまとめて反映 =====
+def create_blob_element(repo, local_bytes, path):
+    blob = repo.create_git_blob(base64.b64encode(local_bytes).decode('ascii'), 'base64')
+    return InputGitTreeElement(path, '100644', 'blob', sha=blob.sha)
+
+# テキストはツリー作成時に中身を直接渡せるのでブロブ作成の API 呼び出しが要らない
+def create_text_element(text, path):
+    return InputGitTreeElement(path, '100644', 'blob', content=text)
+
+def commit_tree_to_github(repo, tree_elements, commit_msg):
+    ref = repo.get_git_ref(f"heads/{BRANCH_NAME}")
+    parent = repo.get_git_commit(ref.object.sha)
+    tree = repo.create_git_tree(tree_elements, base_tree=parent.tree)
+    # 中身が前回と同じならツリーの SHA も同じなので空コミットは作らない
+    if tree.sha == parent.tree.sha:
+        return None
+    commit = repo.create_git_commit(commit_msg, tree, [parent])
+    ref.edit(commit.sha)
+    return commit.sha
+
+# ===== ポップアップ画像（長辺 POPUP_MAX_SIZE に縮小済みのものを渡す） =====
 def create_popup_jpeg(image):
+    if image.mode != "RGB":
+        image = image.convert("RGB")
     with io.BytesIO() as output:
-        image.convert("RGB").save(output, "JPEG", quality=85)
+        # 4:2:0 は libjpeg-turbo の SIMD ダウンサンプリングが効く
+        image.save(output, "JPEG", quality=80, subsampling=2, optimize=True, progressive=True)
         return output.getvalue()
 
-# ===== アイコン生成（丸・白枠・元サイズ出力） =====
-def create_round_icon_webp(image, base_size=480, border_thickness=6):
-    w, h = image.size
-    min_side = min(w, h)
-    left = (w - min_side)//2
-    top = (h - min_side)//2
-    square = image.crop((left, top, left+min_side, top+min_side))
-    square = square.resize((base_size, base_size), Image.Resampling.LANCZOS)
+# 元ファイルをそのまま公開する時は EXIF（機種・シリアル・MakerNote・サムネイル等）を落とす
+# 画素はそのままで、表示の向きが変わらないよう Orientation だけ残す
+def strip_jpeg_exif(jpeg_bytes, exif_bytes):
+    orientation = None
+    if exif_bytes:
+        try:
+            orientation = piexif.load(exif_bytes)['0th'].get(piexif.ImageIFD.Orientation)
+        except Exception:
+            pass
+    with io.BytesIO() as output:
+        if orientation:
+            piexif.insert(piexif.dump({'0th': {piexif.ImageIFD.Orientation: orientation}}), jpeg_bytes, output)
+        else:
+            piexif.remove(jpeg_bytes, output)
+        return output.getvalue()
 
+# ===== アイコン生成（丸・白枠・元サイズ出力） =====
+# 白枠とマスクはサイズだけで決まるので使い回す（copy して使うこと）
+@functools.lru_cache(maxsize=16)
+def _border_assets(base_size, border_thickness):
     canvas_size = base_size + 2*border_thickness
-    canvas = Image.new("RGBA", (canvas_size, canvas_size), (0,0,0,0))
 
     mask_outer = Image.new("L", (canvas_size, canvas_size), 0)
     draw_outer = ImageDraw.Draw(mask_outer)
@@ -106,101 +217,227 @@ def create_round_icon_webp(image, base_size=480, border_thickness=6):
          canvas_size-border_thickness, canvas_size-border_thickness),
         fill=0
     )
+    border_template = Image.new("RGBA", (canvas_size, canvas_size), (0,0,0,0))
     border = Image.new("RGBA", (canvas_size, canvas_size), (255,255,255,255))
-    canvas.paste(border, (0,0), mask_outer)
+    border_template.paste(border, (0,0), mask_outer)
 
-    mask_inner = Image.new("L", (base_size, base_size), 0)
-    draw_inner = ImageDraw.Draw(mask_inner)
+    circle_mask = Image.new("L", (base_size, base_size), 0)
+    draw_inner = ImageDraw.Draw(circle_mask)
     draw_inner.ellipse((0,0,base_size,base_size), fill=255)
-    canvas.paste(square, (border_thickness,border_thickness), mask_inner)
+    return circle_mask, border_template
+
+def create_round_icon_webp(image, base_size=480, border_thickness=6):
+    w, h = image.size
+    min_side = min(w, h)
+    left = (w - min_side)//2
+    top = (h - min_side)//2
+    square = image.crop((left, top, left+min_side, top+min_side))
+    square = square.resize((base_size, base_size), Image.Resampling.LANCZOS)
+
+    circle_mask, border_template = _border_assets(base_size, border_thickness)
+    canvas = border_template.copy()
+    canvas.paste(square, (border_thickness,border_thickness), circle_mask)
 
     with io.BytesIO() as output:
-        canvas.save(output, "WEBP", quality=95, method=6)
+        canvas.save(output, "WEBP", quality=80, method=6)
         return output.getvalue()
 
 # ===== キャッシュ読み込み =====
-try:
-    contents = repo.get_contents(CACHE_FILE, ref=BRANCH_NAME)
-    cached_files = json.loads(contents.decoded_content.decode())
-except:
-    cached_files = {}
+def load_cache(repo):
+    try:
+        contents = repo.get_contents(CACHE_FILE, ref=BRANCH_NAME)
+        return json.loads(contents.decoded_content.decode())
+    except:
+        return {}
 
-rows = []
-for f in list_image_files(FOLDER_ID):
-    if f['id'] in cached_files:
-        rows.append(cached_files[f['id']])
-        continue
+# md5Checksum（なければ modifiedTime）が一致すればダウンロード〜画像生成を省略
+# （どちらも記録されていない古いキャッシュ行はそのまま使う）
+def is_cache_fresh(cached_row, f):
+    cached_md5 = cached_row.get('md5Checksum')
+    if cached_md5 and f.get('md5Checksum'):
+        return cached_md5 == f['md5Checksum']
+    cached_mtime = cached_row.get('modifiedTime')
+    return cached_mtime is None or cached_mtime == f.get('modifiedTime')
 
+# ===== Drive からダウンロード（ワーカースレッドで実行） =====
+def fetch_media(creds, file_id, byte_range=None):
+    request = get_drive_service(creds).files().get_media(fileId=file_id)
+    if byte_range:
+        request.headers['Range'] = f"bytes={byte_range}"
+    return request.execute(num_retries=DRIVE_NUM_RETRIES)
+
+def header_has_gps(head):
+    try:
+        with Image.open(io.BytesIO(head)) as src:
+            lat, lon, _ = extract_exif(src.info.get('exif'))
+    except Exception:
+        # 先頭だけでは判定できない時は全体を取得する
+        return True
+    return bool(lat and lon)
+
+def download_file(creds, f):
     print(f"Processing new file: {f['name']}...")
     try:
-        file_bytes = drive_service.files().get_media(fileId=f['id']).execute()
+        # 先頭だけ取得して GPS がなければ残りはダウンロードしない
+        # （render_photo は先頭だけでも EXIF を読んで GPS なしとして返す）
+        if f.get('mimeType') in EXIF_PROBE_MIME_TYPES and int(f.get('size', 0)) > EXIF_PROBE_BYTES:
+            head = fetch_media(creds, f['id'], f"0-{EXIF_PROBE_BYTES - 1}")
+            if len(head) != EXIF_PROBE_BYTES or not header_has_gps(head):
+                return head
+            return head + fetch_media(creds, f['id'], f"{EXIF_PROBE_BYTES}-")
+        return fetch_media(creds, f['id'])
     except Exception as e:
         print(f"⚠️ Skipped {f['name']}: {e}")
-        continue
+        return None
 
-    lat, lon, dt = extract_exif(file_bytes)
-    image = Image.open(io.BytesIO(file_bytes)).convert("RGB")
-    base_name, _ = os.path.splitext(f['name'])
-    popup_path = f"{IMAGES_DIR}/{base_name}_popup.jpg"
-    icon_path = f"{IMAGES_DIR}/{base_name}_icon.webp"
+# ===== EXIF〜ポップアップ・アイコン生成（ワーカープロセスで実行、引数と戻り値は bytes のみ） =====
+def render_photo(file_bytes, mime_type):
+    with Image.open(io.BytesIO(file_bytes)) as src:
+        exif_bytes = src.info.get('exif')
+        lat, lon, dt = extract_exif(exif_bytes)
+        # 位置情報がなければ地図に出ないので画素はデコードしない
+        if not (lat and lon):
+            return lat, lon, dt, None, None
+        original_size = src.size
+        # JPEG は libjpeg の DCT スケーリング（1/2〜1/8）で縮小しながらデコード
+        # （結果はポップアップサイズ以上になる。HEIC は十分大きい埋め込みサムネイルがあればそれを使う）
+        scale = POPUP_MAX_SIZE / max(original_size)
+        if scale < 1:
+            src.draft('RGB', (int(original_size[0]*scale), int(original_size[1]*scale)))
+        # 同じモードへの convert は全画素のコピーになるので必要な時だけ
+        src.load()
+        image = src if src.mode == "RGB" else src.convert("RGB")
 
-    # ポップアップ画像（元サイズ）
-    popup_bytes = create_popup_jpeg(image)
-    popup_url = upload_file_to_github(popup_bytes, popup_path, f"Upload popup {base_name}")
+    # ポップアップ画像（小さい JPEG は EXIF だけ落として元の画素のまま、それ以外は縮小して再エンコード）
+    if (mime_type == 'image/jpeg' and len(file_bytes) <= POPUP_PASSTHROUGH_MAX_BYTES
+            and max(original_size) <= POPUP_MAX_SIZE):
+        popup_bytes = strip_jpeg_exif(file_bytes, exif_bytes)
+    else:
+        # thumbnail はその場で縮小するのでコピーは作らない
+        image.thumbnail((POPUP_MAX_SIZE, POPUP_MAX_SIZE), Image.Resampling.LANCZOS)
+        popup_bytes = create_popup_jpeg(image)
 
-    # アイコン生成（元サイズ）
+    # アイコン生成（縮小後の画像から）
     icon_bytes = create_round_icon_webp(image)
-    icon_url = upload_file_to_github(icon_bytes, icon_path, f"Upload round icon {base_name}")
-
-    row = {
-        'filename': f['name'],
-        'latitude': lat,
-        'longitude': lon,
-        'datetime': dt,
-        'popup_url': popup_url,
-        'icon_url': icon_url
-    }
-    rows.append(row)
-    cached_files[f['id']] = row
-
-# ===== キャッシュ保存 =====
-upload_file_to_github(json.dumps(cached_files), CACHE_FILE, "Update photomap cache")
-
-# ===== HTML生成（ポップアップ自動スクロール付き） =====
-html_lines = [
-    "<!DOCTYPE html>",
-    "<html><head><meta charset='utf-8'><title>Photo Map</title>",
-    "<style>#map { height: 100vh; width: 100%; }</style>",
-    "<link rel='stylesheet' href='https://unpkg.com/leaflet@1.9.4/dist/leaflet.css'/>",
-    "<script src='https://unpkg.com/leaflet@1.9.4/dist/leaflet.js'></script></head><body>",
-    "<div id='map'></div><script>",
-    "var map = L.map('map').setView([35.0, 138.0], 5);",
-    "L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png', {maxZoom:19}).addTo(map);",
-    "var markers = [];"]
-
-for row in rows:
-    if row['latitude'] and row['longitude']:
-        html_lines.append(f"""
-var icon = L.icon({{
-    iconUrl: '{row['icon_url']}',
-    iconSize: [80, 80], // HTMLで調整可能
-    className: 'custom-icon'
-}});
-var marker = L.marker([{row['latitude']},{row['longitude']}], {{icon: icon}}).addTo(map);
-marker.bindPopup(
-    "<b>{row['filename']}</b><br>{row['datetime']}<br>"
-    + "<a href='https://www.google.com/maps/search/?api=1&query={row['latitude']},{row['longitude']}' target='_blank'>Google Mapsで開く</a><br>"
-    + "<img src='{row['popup_url']}' style='width:800px; height:auto;'/>",
-    {{
-        maxWidth: 820,        // ポップアップ幅
-        autoPan: true,        // ポップアップ開いたら自動スクロール
-        autoPanPadding: [50,50] // 端から余白50px
-    }}
-);
-""")
-
-html_lines.append("</script></body></html>")
-
-html_str = "\n".join(html_lines)
-upload_file_to_github(html_str, HTML_NAME, "Update HTML with auto-pan popups")
-print("HTML updated on GitHub: popup auto-pan enabled, width fixed 800px, icon adjustable.")
+    # 画素バッファはここで解放
+    image.close()
+    return lat, lon, dt, popup_bytes, icon_bytes
+
+def main():
+    creds = load_drive_credentials()
+    repo = get_github_repo()
+    cached_files = load_cache(repo)
+
+    drive_files = list_image_files(creds, FOLDER_ID)
+    new_files = []
+    cache_dirty = False
+    for f in drive_files:
+        cached_row = cached_files.get(f['id'])
+        if cached_row is None or not is_cache_fresh(cached_row, f):
+            new_files.append(f)
+        else:
+            # 古いキャッシュ行にも md5 / modifiedTime を記録して次回から変更を検知できるようにする
+            for key in ('md5Checksum', 'modifiedTime'):
+                if not cached_row.get(key) and f.get(key):
+                    cached_row[key] = f[key]
+                    cache_dirty = True
+
+    # ダウンロードはスレッド、デコード〜エンコードは GIL を避けてプロセスで並列実行
+    # 描画待ちを RENDER_QUEUE_SIZE 件までに抑え、終わったものから順に GitHub へ送る
+    # （メモリに載る元画像は常に RENDER_QUEUE_SIZE 枚まで）
+    tree_elements = []
+    pending_files = iter(new_files)
+    downloading = {}
+    rendering = {}
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as downloads, \
+            ProcessPoolExecutor(max_workers=RENDER_WORKERS,
+                                mp_context=multiprocessing.get_context('spawn')) as renders:
+        while True:
+            while len(downloading) < MAX_WORKERS and len(downloading) + len(rendering) < RENDER_QUEUE_SIZE:
+                f = next(pending_files, None)
+                if f is None:
+                    break
+                downloading[downloads.submit(download_file, creds, f)] = f
+            if not (downloading or rendering):
+                break
+
+            done, _ = wait([*downloading, *rendering], return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in downloading:
+                    f = downloading.pop(future)
+                    file_bytes = future.result()
+                    if file_bytes is None:
+                        continue
+                    try:
+                        rendering[renders.submit(render_photo, file_bytes, f.get('mimeType'))] = f
+                    except Exception as e:
+                        # ワーカーが落ちてプールが使えなくなった時など
+                        print(f"⚠️ Skipped {f['name']}: {e}")
+                    del file_bytes
+                    continue
+
+                # 描画に失敗したファイルはキャッシュに載せず、次回また処理する
+                f = rendering.pop(future)
+                try:
+                    lat, lon, dt, popup_bytes, icon_bytes = future.result()
+                except Exception as e:
+                    print(f"⚠️ Skipped {f['name']}: {e}")
+                    continue
+
+                # GitHub への送信はメインスレッドで行う
+                popup_url = icon_url = ''
+                if popup_bytes is not None:
+                    base_name, _ = os.path.splitext(f['name'])
+                    popup_path = f"{IMAGES_DIR}/{base_name}_popup.jpg"
+                    icon_path = f"{IMAGES_DIR}/{base_name}_icon.webp"
+                    tree_elements.append(create_blob_element(repo, popup_bytes, popup_path))
+                    tree_elements.append(create_blob_element(repo, icon_bytes, icon_path))
+                    popup_url = pages_url(popup_path)
+                    icon_url = pages_url(icon_path)
+                else:
+                    print(f"No GPS, skipped images: {f['name']}")
+                del popup_bytes, icon_bytes
+
+                cache_dirty = True
+                cached_files[f['id']] = {
+                    'filename': f['name'],
+                    'latitude': lat,
+                    'longitude': lon,
+                    'datetime': dt,
+                    'popup_url': popup_url,
+                    'icon_url': icon_url,
+                    'md5Checksum': f.get('md5Checksum'),
+                    'modifiedTime': f.get('modifiedTime')
+                }
+
+    rows = [cached_files[f['id']] for f in drive_files if f['id'] in cached_files]
+
+    # ===== キャッシュ保存（変更があった時だけ） =====
+    if cache_dirty:
+        tree_elements.append(create_text_element(json.dumps(cached_files), CACHE_FILE))
+
+    # ===== 写真データ（photos.json、HTML から fetch して使う） =====
+    photos = [
+        {
+            'lat': row['latitude'],
+            'lon': row['longitude'],
+            'filename': row['filename'],
+            'datetime': row['datetime'],
+            'popup': row['popup_url'],
+            'icon': row['icon_url']
+        }
+        for row in rows if row['latitude'] and row['longitude']
+    ]
+    tree_elements.append(create_text_element(
+        json.dumps(photos, ensure_ascii=False, separators=(',', ':')), PHOTOS_JSON_NAME))
+
+    tree_elements.append(create_text_element(MAP_HTML, HTML_NAME))
+
+    # ===== 画像・キャッシュ・photos.json・HTML を 1 コミットで反映 =====
+    if commit_tree_to_github(repo, tree_elements, "Update photo map") is None:
+        print("No changes: photo map is up to date.")
+        return
+    print("HTML updated on GitHub: popup auto-pan enabled, width fixed 800px, icon adjustable.")
+
+if __name__ == "__main__":
+    main()